@@ -184,6 +184,7 @@ setup(
     entry_points={  # Optional
         'console_scripts': [
             'voxface=voxface.__main__:main',
+            'voxface-server=voxface.server:main',
         ],
     },
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Tests for pipelined batch defacing
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import os.path as op
+import queue
+import threading
+
+from voxface.batch import read_manifest, _run_stage
+
+
+def test_read_manifest(tmp_path):
+
+    manifest_fname = tmp_path / 'manifest.txt'
+    manifest_fname.write_text('# Faced images\nsub-01_T1w.nii.gz\n\n  sub-02_T1w.nii  \n#sub-03_T1w.nii.gz\n')
+
+    assert read_manifest(str(manifest_fname)) == [
+        op.realpath('sub-01_T1w.nii.gz'),
+        op.realpath('sub-02_T1w.nii')
+    ]
+
+
+def test_run_stage_passes_failed_jobs_through():
+
+    q_in, q_out = queue.Queue(), queue.Queue()
+    err = ValueError('unreadable header')
+
+    for job in ({'in_fname': 'a', 'error': err}, {'in_fname': 'b', 'error': None}, None):
+        q_in.put(job)
+
+    visited = []
+    _run_stage(lambda job: visited.append(job['in_fname']), q_in, q_out, threading.Event())
+
+    assert visited == ['b']
+    assert q_out.get() == {'in_fname': 'a', 'error': err}
+    assert q_out.get() == {'in_fname': 'b', 'error': None}
+    assert q_out.get() is None
+
+
+def test_run_stage_records_stage_errors():
+
+    q_in, q_out = queue.Queue(), queue.Queue()
+    q_in.put({'in_fname': 'a', 'error': None})
+    q_in.put(None)
+
+    def fail(job):
+        raise RuntimeError('registration failed')
+
+    _run_stage(fail, q_in, q_out, threading.Event())
+
+    assert isinstance(q_out.get()['error'], RuntimeError)
+    assert q_out.get() is None
+
+
+def test_run_stage_stops_when_downstream_is_full():
+
+    q_in, q_out = queue.Queue(), queue.Queue(maxsize=1)
+    q_in.put({'in_fname': 'a', 'error': None})
+    q_out.put({'in_fname': 'z', 'error': None})
+    stop = threading.Event()
+
+    worker = threading.Thread(target=_run_stage, args=(lambda job: None, q_in, q_out, stop))
+    worker.start()
+
+    # Nothing drains q_out, so the stage only returns once stopped
+    worker.join(timeout=0.5)
+    assert worker.is_alive()
+
+    stop.set()
+    worker.join(timeout=5)
+    assert not worker.is_alive()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for the decoded template image cache
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import numpy as np
+import nibabel as nib
+import ants  # antspyx package
+import pytest
+
+import voxface.cache
+from voxface.cache import load_cached_ants
+
+
+@pytest.fixture
+def template_fname(tmp_path):
+    """
+    Small compressed image with non-trivial origin, spacing and direction
+    """
+
+    affine = np.array([
+        [0.0, -2.0, 0.0, 90.0],
+        [1.5, 0.0, 0.0, -126.0],
+        [0.0, 0.0, 2.5, -72.0],
+        [0.0, 0.0, 0.0, 1.0]
+    ])
+    arr = np.random.default_rng(0).random((6, 7, 8)).astype(np.float32)
+
+    fname = str(tmp_path / 'template.nii.gz')
+    nib.Nifti1Image(arr, affine).to_filename(fname)
+
+    return fname
+
+
+def assert_same_image(img_ai, ref_ai):
+
+    assert np.array_equal(img_ai.numpy(), ref_ai.numpy())
+    assert np.allclose(img_ai.origin, ref_ai.origin)
+    assert np.allclose(img_ai.spacing, ref_ai.spacing)
+    assert np.allclose(img_ai.direction, ref_ai.direction)
+
+
+def test_cache_miss_then_hit(tmp_path, monkeypatch, template_fname):
+
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setattr(voxface.cache, 'user_cache_dir', lambda appname: str(cache_dir))
+
+    ref_ai = ants.image_read(template_fname)
+
+    # Miss decodes the image and writes both cache files
+    assert_same_image(load_cached_ants(template_fname), ref_ai)
+    cached = sorted(p.name for p in cache_dir.iterdir())
+    assert len(cached) == 2
+    assert cached[0].endswith('.meta.json') and cached[1].endswith('.npy')
+
+    # Hit rebuilds the same image from the cache files
+    assert_same_image(load_cached_ants(template_fname), ref_ai)
+    assert sorted(p.name for p in cache_dir.iterdir()) == cached
+
+
+def test_unwritable_cache_dir(tmp_path, monkeypatch, template_fname):
+
+    # A file in the way makes the cache directory impossible to create, even as root
+    blocker = tmp_path / 'blocker'
+    blocker.write_text('')
+    monkeypatch.setattr(voxface.cache, 'user_cache_dir', lambda appname: str(blocker / 'cache'))
+
+    assert_same_image(load_cached_ants(template_fname), ants.image_read(template_fname))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Tests for the face voxelation pipeline stages
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import os
+import os.path as op
+import stat
+
+import numpy as np
+import nibabel as nib
+from nibabel.openers import Opener
+import ants  # antspyx package
+import pytest
+
+import voxface.deface
+from voxface.deface import (thread_count, backup_fname, probe_geometry, voxelation_grid, rescale_pyramid, voxelate_face,
+                            write_nifti, save_defaced)
+
+
+def raw_header(fname):
+    """
+    NIfTI header exactly as stored on disk
+    """
+
+    with Opener(fname) as fd:
+        return nib.Nifti1Header.from_fileobj(fd)
+
+
+def face_mask(shape):
+    """
+    Deface mask with a face region in one corner (1 = retain original voxel)
+    """
+
+    mask = np.ones(shape, dtype=np.float32)
+    mask[:13, 21:, :10] = 0
+
+    return mask
+
+
+def test_thread_count():
+
+    assert thread_count('4') == 4
+
+    for value in ('0', '-2', 'all'):
+        with pytest.raises(ValueError):
+            thread_count(value)
+
+
+def test_voxelation_grid():
+
+    # Integer shrink factors give exact width blocks, with a partial final block
+    x_edges, y_edges, z_edges = voxelation_grid((20, 16, 10), (1.0, 2.0, 0.8), 8.0)
+    assert x_edges.tolist() == [0, 8, 16, 20]
+    assert y_edges.tolist() == [0, 4, 8, 12, 16]
+    assert z_edges.tolist() == [0, 10]
+
+    # Non-integer shrink factors split the axis into near-equal blocks
+    x_edges, = voxelation_grid((30,), (0.7,), 8.0)
+    assert x_edges.tolist() == [0, 10, 20, 30]
+
+
+def test_rescale_pyramid():
+
+    # 1 mm fixed image downsampled to 2 mm keeps the same physical levels
+    assert rescale_pyramid((6, 4), (3, 2), 2.0) == ((3, 2), (1.5, 1.0))
+    assert rescale_pyramid((6, 4, 2, 1), (3, 2, 1, 0), 2.0) == ((3, 2, 1, 1), (1.5, 1.0, 0.5, 0.0))
+    assert rescale_pyramid((6, 4), (3, 2), 1.0) == ((6, 4), (3.0, 2.0))
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('dtype, slope, inter', [
+    (np.int16, 2.5, 10.0),
+    (np.float32, None, None)
+])
+def test_voxelate_round_trip(tmp_path, ext, dtype, slope, inter):
+
+    shape = (32, 40, 24)
+    rng = np.random.default_rng(0)
+    stored = rng.integers(-1000, 3000, size=shape).astype(dtype)
+
+    in_fname = str(tmp_path / ('faced' + ext))
+    out_fname = str(tmp_path / ('defaced' + ext))
+
+    # Faced image with known stored values and scaling
+    in_header = nib.Nifti1Header()
+    in_header.set_data_shape(shape)
+    in_header.set_data_dtype(dtype)
+    in_header.set_sform(np.eye(4), code=1)
+    in_header.set_slope_inter(slope, inter)
+    write_nifti(stored, in_header, in_fname)
+
+    expected = stored * (slope or 1.0) + (inter or 0.0)
+    assert np.allclose(nib.load(in_fname).get_fdata(), expected)
+
+    shape, spacing, header = probe_geometry(in_fname)
+    grid = voxelation_grid(shape, spacing, 8.0)
+
+    mask = face_mask(shape)
+    faced_ai = ants.image_read(in_fname)
+    voxfaced_arr = voxelate_face(faced_ai, ants.from_numpy(mask), grid, header)
+
+    assert voxfaced_arr.dtype == dtype
+
+    write_nifti(voxfaced_arr, header, out_fname)
+
+    # Header is written byte for byte unchanged, scaling included
+    assert raw_header(out_fname).binaryblock == raw_header(in_fname).binaryblock
+
+    out_stored = np.asanyarray(nib.load(out_fname).dataobj.get_unscaled())
+
+    # Stored values outside the face are untouched, face values are voxelated
+    assert np.array_equal(out_stored[mask == 1], stored[mask == 1])
+    assert not np.array_equal(out_stored[mask == 0], stored[mask == 0])
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.int32])
+def test_probe_geometry_rejects_inexact_dtypes(tmp_path, dtype):
+
+    fname = str(tmp_path / 'faced.nii.gz')
+    nib.Nifti1Image(np.zeros((4, 5, 6), dtype=dtype), np.eye(4)).to_filename(fname)
+
+    with pytest.raises(ValueError, match='cannot be voxelated'):
+        probe_geometry(fname)
+
+
+def faced_image(fname):
+    """
+    Small int16 faced image, returning its stored values and header
+    """
+
+    stored = np.arange(4 * 5 * 6, dtype=np.int16).reshape((4, 5, 6))
+    header = nib.Nifti1Header()
+    header.set_data_shape(stored.shape)
+    header.set_data_dtype(np.int16)
+    write_nifti(stored, header, fname)
+
+    return stored, header
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+def test_save_defaced_backs_up_original(tmp_path, ext):
+
+    in_fname = str(tmp_path / ('sub-01_T1w' + ext))
+    stored, header = faced_image(in_fname)
+    os.chmod(in_fname, 0o664)
+
+    with open(in_fname, 'rb') as fd:
+        original_bytes = fd.read()
+
+    save_defaced(-stored, header, in_fname)
+
+    bak_fname = backup_fname(in_fname)
+    assert bak_fname == str(tmp_path / ('sub-01_T1w_faced' + ext))
+
+    with open(bak_fname, 'rb') as fd:
+        assert fd.read() == original_bytes
+
+    assert np.array_equal(np.asanyarray(nib.load(in_fname).dataobj), -stored)
+    assert stat.S_IMODE(os.stat(in_fname).st_mode) == 0o664
+    assert sorted(os.listdir(tmp_path)) == sorted(op.basename(f) for f in (in_fname, bak_fname))
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+def test_save_defaced_failed_write(tmp_path, monkeypatch, ext):
+
+    in_fname = str(tmp_path / ('sub-01_T1w' + ext))
+    stored, header = faced_image(in_fname)
+
+    with open(in_fname, 'rb') as fd:
+        original_bytes = fd.read()
+
+    # Fail part way through writing the temporary defaced image
+    def failed_write(arr, header, fname, compress_level=1):
+        with open(fname, 'wb') as fd:
+            fd.write(b'partial')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(voxface.deface, 'write_nifti', failed_write)
+
+    with pytest.raises(OSError):
+        save_defaced(-stored, header, in_fname)
+
+    assert os.listdir(tmp_path) == [op.basename(in_fname)]
+
+    with open(in_fname, 'rb') as fd:
+        assert fd.read() == original_bytes
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Tests for the face voxelator server
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import os.path as op
+import socket
+
+from voxface.server import clear_stale_socket
+
+
+def test_clear_stale_socket_missing(tmp_path):
+
+    assert clear_stale_socket(str(tmp_path / 'voxface.sock')) is None
+
+
+def test_clear_stale_socket_dead_server(tmp_path):
+
+    sock_fname = str(tmp_path / 'voxface.sock')
+
+    # Bound but never listening, as left behind by a killed server
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(sock_fname)
+
+    assert clear_stale_socket(sock_fname) is None
+    assert not op.lexists(sock_fname)
+
+
+def test_clear_stale_socket_live_server(tmp_path):
+
+    sock_fname = str(tmp_path / 'voxface.sock')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(sock_fname)
+        sock.listen()
+
+        assert 'already listening' in clear_stale_socket(sock_fname)
+        assert op.lexists(sock_fname)
+
+
+def test_clear_stale_socket_not_a_socket(tmp_path):
+
+    fname = tmp_path / 'sub-01_T1w.nii.gz'
+    fname.write_bytes(b'faced image')
+
+    assert 'not a socket' in clear_stale_socket(str(fname))
+    assert fname.read_bytes() == b'faced image'
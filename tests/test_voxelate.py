@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Tests for the block voxelation kernels
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import numpy as np
+import pytest
+
+from voxface.voxelate import block_edges, shrink_edges, crop_edges, face_bbox, blockavg_paint
+
+
+def reference_voxelate(arr, mask, x_edges, y_edges, z_edges, round_mean):
+    """
+    Block mean painted into the face voxels of each block, in plain NumPy
+    """
+
+    out = arr.copy()
+
+    for i0, i1 in zip(x_edges[:-1], x_edges[1:]):
+        for j0, j1 in zip(y_edges[:-1], y_edges[1:]):
+            for k0, k1 in zip(z_edges[:-1], z_edges[1:]):
+                block_mean = arr[i0:i1, j0:j1, k0:k1].astype(np.float64).mean()
+                if round_mean:
+                    block_mean = np.floor(block_mean + 0.5)
+                face = mask[i0:i1, j0:j1, k0:k1] == 0
+                out[i0:i1, j0:j1, k0:k1][face] = block_mean
+
+    return out
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+def test_blockavg_paint_matches_reference(dtype):
+
+    rng = np.random.default_rng(0)
+    shape = (21, 17, 13)
+    arr = np.asfortranarray(rng.integers(-500, 2000, size=shape).astype(dtype))
+    mask = np.asfortranarray((rng.random(shape) > 0.3).astype(np.uint8))
+    round_mean = np.issubdtype(dtype, np.integer)
+
+    # Uneven blocks along every axis
+    x_edges, y_edges, z_edges = block_edges(21, 4), block_edges(17, 3), block_edges(13, 2)
+
+    expected = reference_voxelate(arr, mask, x_edges, y_edges, z_edges, round_mean)
+    blockavg_paint(arr, mask, x_edges, y_edges, z_edges, round_mean)
+
+    if round_mean:
+        assert np.array_equal(arr, expected)
+    else:
+        assert np.allclose(arr, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('n, f, expected', [
+    (16, 4, [0, 4, 8, 12, 16]),
+    (18, 4, [0, 4, 8, 12, 16, 18]),
+    (3, 4, [0, 3]),
+    (5, 0, [0, 1, 2, 3, 4, 5])
+])
+def test_shrink_edges(n, f, expected):
+
+    assert shrink_edges(n, f).tolist() == expected
+
+
+def test_face_bbox():
+
+    mask = np.ones((10, 12, 14), dtype=np.uint8)
+    assert face_bbox(mask) is None
+
+    mask[2:5, 7:12, 0:3] = 0
+    mask[6, 8, 1] = 0
+    assert face_bbox(mask) == [(2, 7), (7, 12), (0, 3)]
+
+
+@pytest.mark.parametrize('lo, hi, expected', [
+    (0, 20, [0, 5, 10, 15, 20]),
+    (5, 10, [5, 10]),
+    (6, 9, [5, 10]),
+    (4, 11, [0, 5, 10, 15]),
+    (19, 20, [15, 20])
+])
+def test_crop_edges(lo, hi, expected):
+
+    edges = np.array([0, 5, 10, 15, 20])
+    assert crop_edges(edges, lo, hi).tolist() == expected
@@ -0,0 +1,12 @@
+import os
+
+# ITK defaults to a conservative thread count unless told otherwise
+# ITK reads this when its first multithreaded filter runs, not when ANTs is
+# imported, so --threads can still override it before any image is read
+# Use the CPUs this process may run on (eg a batch job allocation) where known
+try:
+    n_cpus = len(os.sched_getaffinity(0))
+except AttributeError:
+    n_cpus = os.cpu_count()
+
+os.environ.setdefault('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', str(n_cpus))
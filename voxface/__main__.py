@@ -29,24 +29,32 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
 import os.path as op
 import sys
 import argparse
 import time
+from concurrent.futures import ThreadPoolExecutor
 from importlib.metadata import version
-from importlib.resources import (files, as_file)
 
-import numpy as np
 import ants  # antspyx package
 
+from voxface.cache import load_cached_ants
+from voxface.deface import (template_fnames, load_templates, add_deface_args, set_itk_threads, backup_fname,
+                            probe_geometry, voxelation_grid, register_template, transform_facemask,
+                            voxelate_face, save_defaced)
+from voxface.batch import read_manifest, run_batch
+from voxface.voxelate import warmup
+
 
 def main():
 
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Fast MRI face voxelator')
-    parser.add_argument('-i', '--infile', required=True, help='Structural MRI with intact face')
-    parser.add_argument('--voxdim', default=8.0, type=float,
-                        help='Voxelation dimension in mm [8.0]')
+    in_group = parser.add_mutually_exclusive_group(required=True)
+    in_group.add_argument('-i', '--infile', help='Structural MRI with intact face')
+    in_group.add_argument('--batch', help='Text file listing structural MRIs to deface, one per line')
+    add_deface_args(parser)
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="Verbose output [False]")
     parser.add_argument('-V', '--version', action='store_true', default=False,
@@ -65,15 +73,18 @@ def main():
         print('VOXFACE {}'.format(ver))
         sys.exit(1)
 
-    if args.infile:
-        in_fname = op.realpath(args.infile)
-    else:
-        print('* No faced image provided - exiting')
-        sys.exit(1)
+    # Override ITK thread count if requested
+    set_itk_threads(args.threads)
+
+    if args.batch:
+        batch_main(args, ver)
+        return
+
+    in_fname = op.realpath(args.infile)
 
     # Backup filename for original faced image
     # Original faced image is overwritten
-    bak_fname = in_fname.replace('.nii.gz', '_faced.nii.gz')
+    bak_fname = backup_fname(in_fname)
 
     if args.verbose:
 
@@ -83,104 +94,113 @@ def main():
         print('New defaced image  : {}'.format(in_fname))
         print('Faced backup image : {}'.format(bak_fname))
         print('Voxelation size    : {} mm'.format(args.voxdim))
+        print('ITK threads        : {}'.format(os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']))
         print('')
 
     # Start timer
     tic = time.perf_counter()
 
-    # Load faced image as an AntsImage
+    t1_template_fname, facemask_fname = template_fnames()
+
+    # Load faced image, T1 template and template facemask concurrently
+    # ITK releases the GIL during file I/O and gzip decoding
     if args.verbose:
-        print('Loading faced image')
+        print('Loading faced image, T1 template and template facemask')
 
-    # Create and ANTs image object for the faced structural
-    faced_ai = ants.image_read(in_fname)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        faced_future = executor.submit(ants.image_read, in_fname)
+        template_future = executor.submit(load_cached_ants, t1_template_fname)
+        facemask_future = executor.submit(load_cached_ants, facemask_fname)
 
-    # Get a PosixPath for the package files
-    tpl_dir = op.join(files(pack_name), 'templates')
+        # Plan the voxelation grid from the header while the images decode
+        shape, spacing, header = probe_geometry(in_fname)
+        grid = voxelation_grid(shape, spacing, args.voxdim)
 
-    # Load template image
-    t1_template_fname = op.join(tpl_dir, 'ConteCore2_50_T1w_2mm.nii.gz')
-    if args.verbose:
-            print('Loading T1 template')
-    template_ai = ants.image_read(t1_template_fname)
+        # Load the cached voxelation kernel (or compile it on first use) on this
+        # thread while the images decode
+        warmup()
 
-    # Load deface mask
-    facemask_fname = op.join(tpl_dir, 'ConteCore2_50_2mm_deface_mask.nii.gz')
-    if args.verbose:
-        print('Loading template facemask')
-    facemask_ai = ants.image_read(facemask_fname)
+        faced_ai = faced_future.result()
+        template_ai = template_future.result()
 
-    # Affine register template to faced image
-    if args.verbose:
-        print('Registering template to individual space')
+        # Affine register template to faced image
+        # Registration does not need the facemask, so it may still be decoding
+        if args.verbose:
+            print('Registering template to individual space')
 
-    affine_tx = ants.registration(
-        fixed=faced_ai,
-        moving=template_ai,
-        type_of_transform='AffineFast'
-    )
+        fwdtransforms = register_template(faced_ai, template_ai, args.affinefast, args.sampling)
+
+        facemask_ai = facemask_future.result()
 
     # Apply transform to deface mask
     if args.verbose:
         print('Applying transform to facemask')
 
-    ind_facemask_ai = ants.apply_transforms(
-        fixed=faced_ai,
-        moving=facemask_ai,
-        transformlist=affine_tx['fwdtransforms'],
-        interpolator='nearestNeighbor'
-    )
-
-    # Voxelate input image
-    # 1. Cubic downsample
-    # 2. Nearest neighbor upsample
+    ind_facemask_ai = transform_facemask(faced_ai, facemask_ai, fwdtransforms)
 
-    # Get original image voxel dimensions and matrix size
-    vx, vy, vz = faced_ai.spacing
-    nx, ny, nz = faced_ai.shape
+    # Voxelate input image within the face region
+    if args.verbose:
+        print('Block averaging face region')
 
-    # Downsampled matrix size to yield voxelation of requested dimensions
-    nx_dwn = np.round(nx * vx / args.voxdim).astype(int)
-    ny_dwn = np.round(ny * vy / args.voxdim).astype(int)
-    nz_dwn = np.round(nz * vz / args.voxdim).astype(int)
+    voxfaced_arr = voxelate_face(faced_ai, ind_facemask_ai, grid, header)
 
+    # Move original image to "*_faced.nii[.gz]" and replace it with the defaced image
     if args.verbose:
-        print('Spline downsampling')
+        print('Moving original faced image to {}'.format(bak_fname))
+        print('Replacing {} with defaced/voxelated image'.format(in_fname))
 
-    faced_spdwn_ai = ants.resample_image(
-        image=faced_ai,
-        resample_params=(nx_dwn, ny_dwn, nz_dwn),
-        use_voxels=True,
-        interp_type=4  # B-spline
-    )
+    save_defaced(voxfaced_arr, header, in_fname, args.compress_level)
 
     if args.verbose:
-        print('Nearest neighbor upsampling')
+        toc = time.perf_counter()
+        print('Completed in {:0.1f} seconds'.format(toc-tic))
 
-    voxed_ai = ants.resample_image(
-        image=faced_spdwn_ai,
-        resample_params=(nx, ny, nz),
-        use_voxels=True,
-        interp_type=1  # Nearest neighbor
-    )
 
-    # Replace original with voxelated image within deface mask
-    ones_ai = faced_ai.new_image_like(np.ones(faced_ai.shape))
-    voxfaced_ai = faced_ai * ind_facemask_ai + voxed_ai * (ones_ai - ind_facemask_ai)
+def batch_main(args, ver):
+    """
+    Deface every image listed in a batch manifest in a single process
 
-    # Back up original image to "*_faced.nii.gz"
-    if args.verbose:
-        print('Backing up original faced image to {}'.format(bak_fname))
-    faced_ai.to_filename(bak_fname)
+    :param args: argparse.Namespace, parsed command line arguments
+    :param ver: str, voxface version
+    """
+
+    in_fnames = read_manifest(args.batch)
 
-    # Overwrite original image with defaced/voxelated image
     if args.verbose:
-        print('Overwriting {} with defaced/voxelated image'.format(in_fname))
-    voxfaced_ai.to_filename(in_fname)
+
+        print('')
+        print('Facial Voxelator {}'.format(ver))
+        print('----------------')
+        print('Batch manifest     : {}'.format(args.batch))
+        print('Images to deface   : {}'.format(len(in_fnames)))
+        print('Voxelation size    : {} mm'.format(args.voxdim))
+        print('ITK threads        : {}'.format(os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']))
+        print('')
+
+    # Start timer
+    tic = time.perf_counter()
+
+    # Template and facemask are loaded once, concurrently, and shared by all images
+    template_ai, facemask_ai = load_templates()
+
+    results = run_batch(
+        in_fnames, template_ai, facemask_ai,
+        voxdim=args.voxdim,
+        affinefast=args.affinefast,
+        sampling=args.sampling,
+        compress_level=args.compress_level,
+        verbose=args.verbose
+    )
+
+    n_failed = sum(err is not None for _, err in results)
 
     if args.verbose:
         toc = time.perf_counter()
-        print('Completed in {:0.1f} seconds'.format(toc-tic))
+        print('Completed {} images in {:0.1f} seconds'.format(len(results) - n_failed, toc-tic))
+
+    if n_failed > 0:
+        print('* {} of {} images failed'.format(n_failed, len(results)))
+        sys.exit(1)
 
 
 # This is the standard boilerplate that calls the main() function.
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Pipelined batch defacing of many images in a single process
+
+Each pipeline stage (load, register, transform facemask, voxelate, save)
+runs in its own thread, connected by bounded queues, so different images
+occupy different stages concurrently. Steady-state throughput is set by the
+slowest stage rather than the sum of all stages.
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import os.path as op
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ants  # antspyx package
+
+from voxface.deface import (probe_geometry, voxelation_grid, register_template, transform_facemask,
+                            voxelate_face, save_defaced)
+from voxface.voxelate import warmup
+
+
+def read_manifest(manifest_fname):
+    """
+    Read faced image paths from a batch manifest
+
+    One path per line. Blank lines and lines starting with '#' are ignored.
+
+    :param manifest_fname: str, manifest path
+    :return: list of str, absolute faced image paths
+    """
+
+    with open(manifest_fname, 'r') as fd:
+        lines = [line.strip() for line in fd]
+
+    return [op.realpath(line) for line in lines if line and not line.startswith('#')]
+
+
+def _get(q, stop, timeout=0.1):
+    """
+    Get the next item from q, or None once stop is set
+    """
+
+    while not stop.is_set():
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            pass
+
+    return None
+
+
+def _put(q, item, stop, timeout=0.1):
+    """
+    Put item on q unless stop is set first
+
+    :return: bool, True if the item was queued
+    """
+
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _run_stage(func, q_in, q_out, stop):
+    """
+    Apply a stage function to each job from q_in and pass it on to q_out
+
+    Jobs which failed in an earlier stage are passed through untouched.
+    A None job marks the end of the batch and is forwarded downstream.
+    Setting stop abandons the batch after the current job.
+    """
+
+    while True:
+
+        job = _get(q_in, stop)
+
+        if job is None:
+            _put(q_out, None, stop)
+            return
+
+        if job['error'] is None:
+            try:
+                func(job)
+            except Exception as err:
+                job['error'] = err
+
+        if not _put(q_out, job, stop):
+            return
+
+
+def run_batch(in_fnames, template_ai, facemask_ai, voxdim=8.0, affinefast=False, sampling=0.2,
+              compress_level=1, verbose=False, maxsize=2):
+    """
+    Deface a list of images through a five stage concurrent pipeline
+
+    The template and facemask are loaded once by the caller and shared by all images.
+
+    :param in_fnames: list of str, faced image paths, each overwritten with its defaced version
+    :param template_ai: ANTsImage, T1 template
+    :param facemask_ai: ANTsImage, template deface mask
+    :param voxdim: float, voxelation dimension in mm
+    :param affinefast: bool, use the ANTs AffineFast registration preset
+    :param sampling: float, fraction of voxels sampled by the affine metric
+    :param compress_level: int, gzip compression level of defaced images
+    :param verbose: bool, report each successfully defaced image
+    :param maxsize: int, maximum number of jobs queued between stages
+    :return: list of (in_fname, error) tuples, error is None on success
+    """
+
+    def load(job):
+        job['faced_ai'] = ants.image_read(job['in_fname'])
+
+    def register(job):
+        job['fwdtransforms'] = register_template(job['faced_ai'], template_ai, affinefast, sampling)
+
+    def transform(job):
+        job['ind_facemask_ai'] = transform_facemask(job['faced_ai'], facemask_ai, job['fwdtransforms'])
+
+    def voxelate(job):
+        job['voxfaced_arr'] = voxelate_face(job['faced_ai'], job['ind_facemask_ai'], job['grid'], job['header'])
+
+    def save(job):
+        save_defaced(job['voxfaced_arr'], job['header'], job['in_fname'], compress_level)
+
+    # Voxelation kernel runs in a worker thread so initialize Numba here first
+    warmup()
+
+    stages = [load, register, transform, voxelate, save]
+    queues = [queue.Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    # Datasource plans each voxelation grid from the image header alone
+    def feed():
+        for in_fname in in_fnames:
+            job = {'in_fname': in_fname, 'error': None}
+            try:
+                shape, spacing, job['header'] = probe_geometry(in_fname)
+                job['grid'] = voxelation_grid(shape, spacing, voxdim)
+            except Exception as err:
+                job['error'] = err
+            if not _put(queues[0], job, stop):
+                return
+        _put(queues[0], None, stop)
+
+    results = []
+
+    with ThreadPoolExecutor(max_workers=len(stages) + 1) as executor:
+
+        workers = [executor.submit(feed)] + [
+            executor.submit(_run_stage, func, queues[sc], queues[sc + 1], stop)
+            for sc, func in enumerate(stages)
+        ]
+
+        try:
+
+            # Collect completed jobs in order
+            while True:
+
+                job = queues[-1].get()
+
+                if job is None:
+                    break
+
+                results.append((job['in_fname'], job['error']))
+
+                # Failures are always reported, successes only when verbose
+                if job['error'] is not None:
+                    print('* Failed {} : {}'.format(job['in_fname'], job['error']))
+                elif verbose:
+                    print('Defaced {}'.format(job['in_fname']))
+
+            # Propagate any unexpected worker failure
+            for worker in workers:
+                worker.result()
+
+        finally:
+
+            # Release every worker, eg after a KeyboardInterrupt, so the executor
+            # shutdown cannot wait on stages blocked by full queues
+            stop.set()
+            for q in queues:
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+
+    return results
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+On-disk cache of decoded template images
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import os
+import os.path as op
+import json
+import hashlib
+
+import numpy as np
+import ants  # antspyx package
+from platformdirs import user_cache_dir
+
+
+def load_cached_ants(path):
+    """
+    Load an immutable NIfTI image via a decoded array cache in the user cache directory
+
+    The voxel array is stored as <sha1>.npy with geometry in <sha1>.meta.json,
+    keyed on the SHA1 of the compressed file, so repeat runs skip gzip decoding.
+
+    :param path: str, path to NIfTI image
+    :return: ANTsImage
+    """
+
+    with open(path, 'rb') as fd:
+        sha1 = hashlib.sha1(fd.read()).hexdigest()
+
+    cache_dir = user_cache_dir('voxface')
+    npy_fname = op.join(cache_dir, '{}.npy'.format(sha1))
+    meta_fname = op.join(cache_dir, '{}.meta.json'.format(sha1))
+
+    if op.isfile(npy_fname) and op.isfile(meta_fname):
+
+        with open(meta_fname, 'r') as fd:
+            meta = json.load(fd)
+
+        return ants.from_numpy(
+            np.load(npy_fname, mmap_mode='r'),
+            origin=meta['origin'],
+            spacing=meta['spacing'],
+            direction=np.array(meta['direction'])
+        )
+
+    img_ai = ants.image_read(path)
+
+    meta = {
+        'origin': list(img_ai.origin),
+        'spacing': list(img_ai.spacing),
+        'direction': img_ai.direction.tolist()
+    }
+
+    # Write via temporary files and rename so concurrent runs never see a partial entry
+    # Cache is an optimization only, so an unwritable cache directory is not an error
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        pid = os.getpid()
+        with open('{}.{}.tmp'.format(npy_fname, pid), 'wb') as fd:
+            np.save(fd, img_ai.numpy())
+        with open('{}.{}.tmp'.format(meta_fname, pid), 'w') as fd:
+            json.dump(meta, fd)
+        os.replace('{}.{}.tmp'.format(npy_fname, pid), npy_fname)
+        os.replace('{}.{}.tmp'.format(meta_fname, pid), meta_fname)
+    except OSError:
+        pass
+
+    return img_ai
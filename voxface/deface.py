@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Face voxelation pipeline stages shared by single image and batch modes
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import os
+import os.path as op
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from importlib.resources import files
+
+import numpy as np
+import nibabel as nib
+from nibabel.openers import Opener
+from nibabel.volumeutils import array_to_file
+import ants  # antspyx package
+
+from voxface.cache import load_cached_ants
+from voxface.voxelate import block_edges, shrink_edges, crop_edges, face_bbox, blockavg_paint
+
+# Stored datatypes whose values survive the float32 ANTs image read exactly
+EXACT_DTYPES = (np.uint8, np.int8, np.uint16, np.int16, np.float32)
+
+
+def template_fnames():
+    """
+    Paths to the packaged T1 template and template facemask
+
+    :return: tuple of str, (T1 template path, facemask path)
+    """
+
+    # Get a PosixPath for the package files
+    tpl_dir = op.join(files('voxface'), 'templates')
+    t1_template_fname = op.join(tpl_dir, 'ConteCore2_50_T1w_2mm.nii.gz')
+    facemask_fname = op.join(tpl_dir, 'ConteCore2_50_2mm_deface_mask.nii.gz')
+
+    return t1_template_fname, facemask_fname
+
+
+def load_templates(overlap=None):
+    """
+    Load the T1 template and template facemask concurrently via the decoded array cache
+
+    :param overlap: callable, optional work run on the calling thread while the templates load
+    :return: tuple of ANTsImage, (T1 template, facemask)
+    """
+
+    t1_template_fname, facemask_fname = template_fnames()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        template_future = executor.submit(load_cached_ants, t1_template_fname)
+        facemask_future = executor.submit(load_cached_ants, facemask_fname)
+
+        if overlap is not None:
+            overlap()
+
+        return template_future.result(), facemask_future.result()
+
+
+def add_deface_args(parser):
+    """
+    Add the defacing options shared by voxface and voxface-server
+
+    :param parser: argparse.ArgumentParser
+    """
+
+    parser.add_argument('--voxdim', default=8.0, type=float,
+                        help='Voxelation dimension in mm [8.0]')
+    parser.add_argument('--threads', default=None, type=thread_count,
+                        help='Number of ITK threads for registration and resampling [all available CPUs]')
+    parser.add_argument('--affinefast', action='store_true', default=False,
+                        help='Use the ANTs AffineFast registration preset [False]')
+    parser.add_argument('--sampling', default=0.2, type=sampling_fraction,
+                        help='Fraction of voxels sampled by the affine registration metric, 0 to 1 [0.2]')
+    parser.add_argument('--compress-level', default=1, type=int, choices=range(1, 10), metavar='{1-9}',
+                        help='Gzip compression level of the defaced image, 1 fastest to 9 smallest [1]')
+
+
+def set_itk_threads(n_threads):
+    """
+    Override the ITK thread count, if requested, before any image is read
+
+    :param n_threads: int, number of ITK threads, or None to keep the default
+    """
+
+    if n_threads is not None:
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(n_threads)
+
+
+def backup_fname(in_fname):
+    """
+    Backup filename for original faced image
+
+    :param in_fname: str, faced image path (.nii.gz or .nii)
+    :return: str, backup path "*_faced.nii.gz" or "*_faced.nii"
+    """
+
+    for ext in ('.nii.gz', '.nii'):
+        if in_fname.endswith(ext):
+            return in_fname[:-len(ext)] + '_faced' + ext
+
+    raise ValueError('{} is not a NIfTI image (.nii.gz or .nii)'.format(in_fname))
+
+
+def probe_geometry(path):
+    """
+    Matrix size, voxel dimensions and header of a NIfTI image from its header alone
+
+    Voxel data is memory mapped and never decompressed. Images stored in a
+    datatype that float32 cannot represent exactly (eg float64 or int32) are
+    rejected, since voxels outside the face would not be written back unchanged.
+
+    :param path: str, NIfTI image path
+    :return: tuple, (matrix size, voxel dimensions in mm, Nifti1Header)
+        Matrix size and voxel dimensions are for the first three axes
+    """
+
+    img = nib.load(path, mmap=True)
+
+    # nibabel clears scl_slope and scl_inter in the loaded image header, so
+    # reread the header exactly as stored
+    with Opener(path) as fd:
+        header = img.header_class.from_fileobj(fd)
+
+    dtype = header.get_data_dtype()
+    if dtype.type not in EXACT_DTYPES:
+        raise ValueError('{} datatype {} cannot be voxelated without changing voxels outside the face'.format(
+            path, dtype.name))
+
+    return img.shape[:3], header.get_zooms()[:3], header
+
+
+def voxelation_grid(shape, spacing, voxdim, eps=1e-3):
+    """
+    Voxelation block edges to yield voxelation of requested dimensions
+
+    Where the voxelation dimension is an integer multiple of the voxel dimension
+    (eg 8 mm blocks of 1 mm voxels) the blocks are exactly that many voxels wide.
+    Otherwise the axis is split into near-equal blocks.
+
+    :param shape: tuple, original matrix size
+    :param spacing: tuple, original voxel dimensions in mm
+    :param voxdim: float, voxelation dimension in mm
+    :param eps: float, tolerance for an integer shrink factor
+    :return: tuple of ndarray, voxelation block edge indices along each axis
+    """
+
+    grid = []
+
+    for n, v in zip(shape, spacing):
+
+        f = voxdim / v
+
+        if abs(f - round(f)) < eps:
+            grid.append(shrink_edges(n, int(round(f))))
+        else:
+            grid.append(block_edges(n, int(round(n * v / voxdim))))
+
+    return tuple(grid)
+
+
+def thread_count(value):
+    """
+    ITK thread count, checked to be at least 1
+
+    Also serves as an argparse type, which reports the ValueError as an invalid value.
+
+    :param value: str or int, number of threads
+    :return: int, number of threads
+    """
+
+    n_threads = int(value)
+
+    if n_threads < 1:
+        raise ValueError('thread count must be at least 1, got {}'.format(value))
+
+    return n_threads
+
+
+def sampling_fraction(value):
+    """
+    Affine metric sampling fraction, checked to lie in (0, 1]
+
+    Also serves as an argparse type, which reports the ValueError as an invalid value.
+
+    :param value: str or float, fraction of voxels sampled by the affine metric
+    :return: float, sampling fraction
+    """
+
+    sampling = float(value)
+
+    if not 0.0 < sampling <= 1.0:
+        raise ValueError('sampling fraction must be in (0, 1], got {}'.format(value))
+
+    return sampling
+
+
+def rescale_pyramid(shrink_factors, smoothing_sigmas, ratio):
+    """
+    Registration pyramid for a fixed image downsampled by ratio
+
+    Shrink factors and smoothing sigmas (in voxels) act on the fixed image
+    grid, so both are divided by the downsampling ratio to keep the same
+    physical resolution and smoothing at each level.
+
+    :param shrink_factors: tuple of int, shrink factors for the original fixed image
+    :param smoothing_sigmas: tuple of float, smoothing sigmas in original fixed image voxels
+    :param ratio: float, downsampled to original fixed image voxel size ratio (>= 1)
+    :return: tuple, (shrink factors, smoothing sigmas) for the downsampled fixed image
+    """
+
+    shrink_factors = tuple(max(int(round(f / ratio)), 1) for f in shrink_factors)
+    smoothing_sigmas = tuple(s / ratio for s in smoothing_sigmas)
+
+    return shrink_factors, smoothing_sigmas
+
+
+def register_template(faced_ai, template_ai, affinefast=False, sampling=0.2):
+    """
+    Affine register template to faced image
+
+    :param faced_ai: ANTsImage, faced individual image (fixed)
+    :param template_ai: ANTsImage, T1 template (moving)
+    :param affinefast: bool, use the ANTs AffineFast registration preset
+    :param sampling: float, fraction of voxels sampled by the affine metric
+    :return: list, forward transform filenames
+    """
+
+    # AffineFast is the default ANTs affine pyramid with zero iterations at the
+    # two finest levels. The explicit schedule keeps only the two coarse levels
+    if affinefast:
+        shrink_factors, smoothing_sigmas = (6, 4, 2, 1), (3, 2, 1, 0)
+    else:
+        shrink_factors, smoothing_sigmas = (6, 4), (3, 2)
+
+    # Register at no finer than template resolution
+    # Physical space transforms are resolution independent so still apply to
+    # the full resolution faced image
+    if min(faced_ai.spacing) < min(template_ai.spacing):
+        fixed_ai = ants.resample_image(
+            image=faced_ai,
+            resample_params=template_ai.spacing,
+            use_voxels=False,
+            interp_type=0  # Linear
+        )
+        shrink_factors, smoothing_sigmas = rescale_pyramid(
+            shrink_factors, smoothing_sigmas, min(template_ai.spacing) / min(faced_ai.spacing)
+        )
+    else:
+        fixed_ai = faced_ai
+
+    if affinefast:
+
+        affine_tx = ants.registration(
+            fixed=fixed_ai,
+            moving=template_ai,
+            type_of_transform='AffineFast',
+            aff_random_sampling_rate=sampling,
+            aff_shrink_factors=shrink_factors,
+            aff_smoothing_sigmas=smoothing_sigmas
+        )
+
+    else:
+
+        # Explicit antsRegistration affine schedule
+        # Same coarse levels as AffineFast but without the two zero-iteration
+        # fine levels, which still cost a full-resolution pyramid build
+        # Sparse random sampling of the mutual information metric is ample for
+        # a coarse face mask warp
+        affine_tx = ants.registration(
+            fixed=fixed_ai,
+            moving=template_ai,
+            type_of_transform='Affine',
+            aff_metric='mattes',
+            aff_sampling=32,
+            aff_random_sampling_rate=sampling,
+            aff_iterations=(2100, 1200),
+            aff_shrink_factors=shrink_factors,
+            aff_smoothing_sigmas=smoothing_sigmas
+        )
+
+    return affine_tx['fwdtransforms']
+
+
+def transform_facemask(faced_ai, facemask_ai, fwdtransforms):
+    """
+    Apply template to individual transform to deface mask
+
+    :param faced_ai: ANTsImage, faced individual image
+    :param facemask_ai: ANTsImage, template deface mask
+    :param fwdtransforms: list, forward transform filenames
+    :return: ANTsImage, deface mask in individual space
+    """
+
+    return ants.apply_transforms(
+        fixed=faced_ai,
+        moving=facemask_ai,
+        transformlist=fwdtransforms,
+        interpolator='nearestNeighbor'
+    )
+
+
+def native_array(faced_ai, header):
+    """
+    Voxel data of an ANTs image in the stored datatype of its NIfTI file, without scaling
+
+    ANTs always reads images as float32 with any NIfTI slope and intercept applied.
+    Undo both so the data can be written back with the original header unchanged.
+    Stored values are only recovered exactly for the EXACT_DTYPES checked by
+    probe_geometry, since float32 cannot hold every float64 or large int32 value.
+
+    :param faced_ai: ANTsImage, image read from the NIfTI file
+    :param header: Nifti1Header, header of the same NIfTI file
+    :return: ndarray, unscaled voxel data in the stored datatype
+    """
+
+    # numpy() returns a copy of the image data, so rescale it in place
+    arr = faced_ai.numpy()
+
+    slope, inter = header.get_slope_inter()
+    if inter is not None:
+        arr -= inter
+    if slope is not None:
+        arr /= slope
+
+    dtype = np.dtype(header.get_data_dtype().type)
+
+    if np.issubdtype(dtype, np.integer):
+        np.rint(arr, out=arr)
+
+    return arr.astype(dtype, copy=False)
+
+
+def voxelate_face(faced_ai, ind_facemask_ai, grid, header):
+    """
+    Voxelate faced image within the face region
+
+    Block average the faced image and paint each block mean into the voxels
+    outside the deface mask in a single pass. Works on the stored voxel values
+    and datatype of the original NIfTI file (eg int16), so voxels outside the
+    face are returned exactly as stored.
+
+    :param faced_ai: ANTsImage, faced individual image
+    :param ind_facemask_ai: ANTsImage, deface mask in individual space
+    :param grid: tuple of ndarray, voxelation block edge indices along each axis
+    :param header: Nifti1Header, header of the faced NIfTI file
+    :return: ndarray, defaced/voxelated unscaled voxel data in the stored datatype
+    """
+
+    x_edges, y_edges, z_edges = grid
+
+    voxfaced_arr = native_array(faced_ai, header)
+    mask_arr = ind_facemask_ai.numpy().astype(np.uint8)
+
+    # Only visit the voxelation blocks overlapping the face bounding box
+    bbox = face_bbox(mask_arr)
+
+    if bbox is not None:
+
+        (x0, x1), (y0, y1), (z0, z1) = bbox
+
+        blockavg_paint(
+            voxfaced_arr, mask_arr,
+            crop_edges(x_edges, x0, x1),
+            crop_edges(y_edges, y0, y1),
+            crop_edges(z_edges, z0, z1),
+            np.issubdtype(voxfaced_arr.dtype, np.integer)
+        )
+
+    return voxfaced_arr
+
+
+def write_nifti(arr, header, fname, compress_level=1):
+    """
+    Write unscaled voxel data to NIfTI with a reference header written unchanged
+
+    Unlike Nifti1Image.to_filename, which recalculates scaling, the original
+    datatype, scl_slope and scl_inter are kept, so no rescaling is needed.
+
+    :param arr: ndarray, unscaled voxel data in the header datatype
+    :param header: Nifti1Header, reference header
+    :param fname: str, output path, gzip compressed if ending in .gz
+    :param compress_level: int, gzip compression level (1 fastest - 9 smallest)
+    """
+
+    header = header.copy()
+
+    # Voxel data must start after the header and any extensions
+    min_offset = header.single_vox_offset + header.extensions.get_sizeondisk()
+    if header.get_data_offset() < min_offset:
+        header.set_data_offset(min_offset)
+
+    # Opener only accepts a compression level for compressed files
+    opener_kwargs = {'compresslevel': compress_level} if fname.endswith('.gz') else {}
+
+    with Opener(fname, 'wb', **opener_kwargs) as fd:
+        header.write_to(fd)
+        array_to_file(arr, fd, header.get_data_dtype(), offset=header.get_data_offset(), order='F')
+
+
+def save_defaced(voxfaced_arr, header, in_fname, compress_level=1):
+    """
+    Back up original faced image and overwrite it with the defaced image
+
+    :param voxfaced_arr: ndarray, defaced/voxelated unscaled voxel data
+    :param header: Nifti1Header, header of the faced NIfTI file
+    :param in_fname: str, faced image path, overwritten
+    :param compress_level: int, gzip compression level (1 fastest - 9 smallest)
+    """
+
+    bak_fname = backup_fname(in_fname)
+
+    # Write defaced image alongside the original, keeping its extension
+    if in_fname.endswith('.nii.gz'):
+        tmp_fname = in_fname[:-7] + '.tmp.nii.gz'
+    else:
+        stem, ext = op.splitext(in_fname)
+        tmp_fname = stem + '.tmp' + ext
+
+    try:
+        write_nifti(voxfaced_arr, header, tmp_fname, compress_level)
+        # Keep the original permissions (eg group write in shared BIDS trees)
+        shutil.copymode(in_fname, tmp_fname)
+    except BaseException:
+        if op.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+    # Move original image to "*_faced.nii[.gz]" and defaced image into its place
+    # Renames within a directory are atomic, so each file is always complete
+    os.replace(in_fname, bak_fname)
+    os.replace(tmp_fname, in_fname)
+
+
+def deface_image(in_fname, template_ai, facemask_ai, voxdim=8.0, affinefast=False, sampling=0.2,
+                 compress_level=1):
+    """
+    Deface a single image in place, backing up the original to "*_faced.nii[.gz]"
+
+    :param in_fname: str, faced image path, overwritten
+    :param template_ai: ANTsImage, T1 template
+    :param facemask_ai: ANTsImage, template deface mask
+    :param voxdim: float, voxelation dimension in mm
+    :param affinefast: bool, use the ANTs AffineFast registration preset
+    :param sampling: float, fraction of voxels sampled by the affine metric
+    :param compress_level: int, gzip compression level of defaced image
+    """
+
+    shape, spacing, header = probe_geometry(in_fname)
+    grid = voxelation_grid(shape, spacing, voxdim)
+
+    faced_ai = ants.image_read(in_fname)
+    fwdtransforms = register_template(faced_ai, template_ai, affinefast, sampling)
+    ind_facemask_ai = transform_facemask(faced_ai, facemask_ai, fwdtransforms)
+    voxfaced_arr = voxelate_face(faced_ai, ind_facemask_ai, grid, header)
+
+    save_defaced(voxfaced_arr, header, in_fname, compress_level)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Long-running face voxelator server with preloaded template and warmed kernels
+
+Loads the template and facemask and compiles the voxelation kernel once, then
+defaces each image path sent as a single line over a Unix domain socket,
+replying with the defaced image path or an error message. For example:
+
+    % voxface-server --socket /tmp/voxface.sock &
+    % echo sub-01_T1w.nii.gz | nc -U /tmp/voxface.sock
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import os
+import os.path as op
+import sys
+import stat
+import socket
+import argparse
+import socketserver
+import time
+from importlib.metadata import version
+
+from voxface.deface import load_templates, add_deface_args, set_itk_threads, deface_image
+from voxface.voxelate import warmup
+
+
+def clear_stale_socket(sock_fname):
+    """
+    Remove a socket file left behind by a server that is no longer running
+
+    :param sock_fname: str, Unix domain socket path
+    :return: str, error message if the path cannot be used, otherwise None
+    """
+
+    try:
+        st = os.lstat(sock_fname)
+    except FileNotFoundError:
+        return None
+
+    if not stat.S_ISSOCK(st.st_mode):
+        return '{} exists and is not a socket'.format(sock_fname)
+
+    # Only a refused connection shows that no server is listening
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(sock_fname)
+        except ConnectionRefusedError:
+            os.remove(sock_fname)
+            return None
+        except OSError as err:
+            return 'cannot check socket {} : {}'.format(sock_fname, err)
+
+    return 'a server is already listening on {}'.format(sock_fname)
+
+
+class DefaceHandler(socketserver.StreamRequestHandler):
+    """
+    Deface the image path received on one line and reply with the result
+    """
+
+    def handle(self):
+
+        in_fname = self.rfile.readline().decode('utf-8').strip()
+
+        if not in_fname:
+            return
+
+        # Relative paths are resolved against the server working directory
+        in_fname = op.realpath(in_fname)
+
+        tic = time.perf_counter()
+
+        try:
+            deface_image(in_fname, self.server.template_ai, self.server.facemask_ai, **self.server.deface_kwargs)
+            reply = in_fname
+        except Exception as err:
+            reply = 'ERROR {}'.format(err)
+
+        if self.server.verbose:
+            toc = time.perf_counter()
+            print('{} ({:0.1f} seconds)'.format(reply, toc-tic))
+
+        self.wfile.write('{}\n'.format(reply).encode('utf-8'))
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Fast MRI face voxelator server')
+    parser.add_argument('-s', '--socket', required=True, help='Unix domain socket path to listen on')
+    add_deface_args(parser)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="Verbose output [False]")
+
+    # Parse command line arguments
+    args = parser.parse_args()
+
+    # Override ITK thread count if requested
+    set_itk_threads(args.threads)
+
+    sock_fname = op.realpath(args.socket)
+
+    # Check the socket path before spending time on templates and kernels
+    err_msg = clear_stale_socket(sock_fname)
+    if err_msg:
+        print('* {} - exiting'.format(err_msg))
+        sys.exit(1)
+
+    if args.verbose:
+
+        print('')
+        print('Facial Voxelator Server {}'.format(version('voxface')))
+        print('-----------------------')
+        print('Socket             : {}'.format(sock_fname))
+        print('Voxelation size    : {} mm'.format(args.voxdim))
+        print('ITK threads        : {}'.format(os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']))
+        print('')
+        print('Loading T1 template and template facemask')
+
+    # Compile the voxelation kernel while the templates load
+    if args.verbose:
+        print('Compiling voxelation kernel')
+
+    template_ai, facemask_ai = load_templates(overlap=warmup)
+
+    with socketserver.UnixStreamServer(sock_fname, DefaceHandler) as server:
+
+        server.template_ai = template_ai
+        server.facemask_ai = facemask_ai
+        server.verbose = args.verbose
+        server.deface_kwargs = {
+            'voxdim': args.voxdim,
+            'affinefast': args.affinefast,
+            'sampling': args.sampling,
+            'compress_level': args.compress_level
+        }
+
+        if args.verbose:
+            print('Listening on {}'.format(sock_fname))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(sock_fname)
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Numba kernels for block voxelation of the face region
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+MIT License
+
+Copyright (c) 2021 Mike Tyszka
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+def block_edges(n, n_dwn):
+    """
+    Voxel index edges of n_dwn near-equal blocks spanning n voxels
+
+    :param n: int, number of voxels along axis
+    :param n_dwn: int, number of blocks along axis
+    :return: ndarray, n_dwn + 1 block edge indices
+    """
+
+    n_dwn = max(n_dwn, 1)
+
+    return (np.arange(n_dwn + 1) * n) // n_dwn
+
+
+def shrink_edges(n, f):
+    """
+    Voxel index edges of blocks exactly f voxels wide spanning n voxels
+
+    The final block is partial if n is not a multiple of f.
+
+    :param n: int, number of voxels along axis
+    :param f: int, integer shrink factor
+    :return: ndarray, block edge indices
+    """
+
+    f = max(f, 1)
+
+    return np.append(np.arange(0, n, f), n)
+
+
+def face_bbox(mask):
+    """
+    Bounding box of the face region (voxels where the deface mask is zero)
+
+    :param mask: ndarray, 3D deface mask (1 = retain original voxel)
+    :return: list of (lo, hi) voxel index ranges per axis, or None if no face voxels
+    """
+
+    # Minimum projections of the {0, 1} mask locate the face without
+    # allocating a full complement volume
+    bbox = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        inds = np.flatnonzero(mask.min(axis=other_axes) == 0)
+        if inds.size == 0:
+            return None
+        bbox.append((inds[0], inds[-1] + 1))
+
+    return bbox
+
+
+def crop_edges(edges, lo, hi):
+    """
+    Restrict block edges to the blocks overlapping voxel index range [lo, hi)
+
+    :param edges: ndarray, block edge indices
+    :param lo: int, first voxel index
+    :param hi: int, last voxel index + 1
+    :return: ndarray, block edge indices of overlapping blocks
+    """
+
+    b0 = np.searchsorted(edges, lo, side='right') - 1
+    b1 = np.searchsorted(edges, hi, side='left')
+
+    return edges[b0:b1 + 1]
+
+
+@njit(parallel=True, cache=True)
+def blockavg_paint(arr, mask, x_edges, y_edges, z_edges, round_mean):
+    """
+    Paint block averages of arr back into arr wherever the deface mask is zero
+
+    Equivalent to a box-filter downsample followed by a nearest neighbor
+    upsample and mask blend, without materializing the downsampled, upsampled
+    or blended volumes. Each block mean is taken before that block is painted
+    and blocks are disjoint, so the update is safe in place.
+    Blocks containing no voxels to replace are skipped.
+
+    :param arr: ndarray, faced volume, voxelated in place
+    :param mask: ndarray, uint8 deface mask (1 = retain original voxel)
+    :param x_edges: ndarray, block edge indices along x
+    :param y_edges: ndarray, block edge indices along y
+    :param z_edges: ndarray, block edge indices along z
+    :param round_mean: bool, round block means to the nearest integer for integer arr
+    """
+
+    nbx = x_edges.size - 1
+    nby = y_edges.size - 1
+    nbz = z_edges.size - 1
+
+    for b in prange(nbx * nby * nbz):
+
+        bi = b // (nby * nbz)
+        bj = (b // nbz) % nby
+        bk = b % nbz
+
+        i0, i1 = x_edges[bi], x_edges[bi + 1]
+        j0, j1 = y_edges[bj], y_edges[bj + 1]
+        k0, k1 = z_edges[bk], z_edges[bk + 1]
+
+        # Block sum and count of voxels to replace
+        # Innermost loop runs along x, the contiguous axis of Fortran ordered
+        # ANTs and NIfTI arrays
+        acc = 0.0
+        n_face = 0
+        for k in range(k0, k1):
+            for j in range(j0, j1):
+                for i in range(i0, i1):
+                    acc += arr[i, j, k]
+                    if mask[i, j, k] == 0:
+                        n_face += 1
+
+        if n_face == 0:
+            continue
+
+        block_mean = acc / ((i1 - i0) * (j1 - j0) * (k1 - k0))
+        if round_mean:
+            block_mean = np.floor(block_mean + 0.5)
+
+        for k in range(k0, k1):
+            for j in range(j0, j1):
+                for i in range(i0, i1):
+                    if mask[i, j, k] == 0:
+                        arr[i, j, k] = block_mean
+
+
+def warmup():
+    """
+    Compile blockavg_paint and start Numba's threading layer on the calling thread
+
+    The kernel is cached on disk, so after the first run this only loads the
+    compiled code. Call it while other work (eg image decoding) is in flight.
+
+    Starting the parallel threading layer for the first time from a worker
+    thread can hang interpreter exit with the TBB layer.
+    """
+
+    # ANTsImage.numpy() returns Fortran ordered arrays, and Numba compiles a
+    # separate version of the kernel for each memory layout
+    mask = np.zeros((16, 16, 16), dtype=np.uint8, order='F')
+    edges = block_edges(16, 2)
+
+    # Most common stored datatypes of structural images
+    for dtype in (np.int16, np.float32):
+        arr = np.zeros(mask.shape, dtype=dtype, order='F')
+        blockavg_paint(arr, mask, edges, edges, edges, np.issubdtype(dtype, np.integer))